@@ -16,33 +16,53 @@ If course_id is not provided, it will process all courses.
 '''
 
 import re
+import os
 import asyncio
 import argparse
+import functools
 import logging
 import tempfile
 import subprocess
 import shutil
 import platform
 import json
+import types
+import hashlib
+import concurrent.futures
 from typing import Optional
 from pathlib import Path
-from playwright.async_api import async_playwright, BrowserContext, Page
+from urllib.parse import urljoin
+from playwright.async_api import async_playwright, BrowserContext, Error as PlaywrightError, Page
 from pydantic_settings import BaseSettings
 
+# Optional in-process extraction backend (python-libarchive-c): skips a
+# fork+exec and shared-library reload per archive when available.
+try:
+    import libarchive as _libarchive
+except ImportError:
+    _libarchive = None
+
+# Optional faster JSON codec for the manifests; falls back to stdlib json.
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
 
 
 BASE_URL = "https://lms.sbu.ac.ir"
 LOGIN_URL = f"{BASE_URL}/login/index.php"
 
 
-PERIOD_OFFSET = {
+# Read-only lookup tables; MappingProxyType guards against accidental mutation
+PERIOD_OFFSET = types.MappingProxyType({
     'صبح': 0,
     'ظهر': 12,
     'عصر': 12,
     'شب': 12
-}
+})
 
-PERSIAN_MONTHS = {
+PERSIAN_MONTHS = types.MappingProxyType({
     'فروردین': '01',
     'اردیبهشت': '02',
     'خرداد': '03',
@@ -55,7 +75,32 @@ PERSIAN_MONTHS = {
     'دی': '10',
     'بهمن': '11',
     'اسفند': '12',
-}
+})
+
+# Precompiled patterns for the hot per-item parsing paths
+_HREF_RE = re.compile(r'<a[^>]+href=["\']([^"\']+)["\'][^>]*>.*?آفلاین', re.S)
+_PARENS_RE = re.compile(r"\(([^)]+)\)")
+_DATE_RE = re.compile(r"(\d+)\s+(\S+)\s+(\d+)")
+_TIME_RE = re.compile(r"(\d+):(\d+)\s+(\S+)")
+_PAREN_STRIP = re.compile(r'\([^)]*\)')
+_DIGITS = re.compile(r'\d+')
+_WS = re.compile(r'\s+')
+_ONLINECLASS_RE = re.compile(r'/mod/onlineclass/view\.php\?id=(\d+)')
+_ANCHOR_HREF_RE = re.compile(r'<a[^>]+href=["\']([^"\']+)["\']')
+_HAS_MONTH = re.compile('|'.join(map(re.escape, PERSIAN_MONTHS)))
+
+# Bound lookups for parse_li's per-item hot path
+_MONTH_GET = PERSIAN_MONTHS.get
+_PERIOD_GET = PERIOD_OFFSET.get
+
+# Maps Persian digits to ASCII so the date/time regexes and int() below always
+# run on the pure-ASCII fast path, whichever digits Moodle serves.
+_DIGIT_TRANS = str.maketrans('۰۱۲۳۴۵۶۷۸۹', '0123456789')
+
+# Translation table for sanitize_filename: invalid Windows filename characters
+# become underscores and control characters (ASCII 0-31) are dropped.
+_SANITIZE_TABLE = {ord(c): '_' for c in '<>:"|?*\\/'}
+_SANITIZE_TABLE.update({i: None for i in range(32)})
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -73,6 +118,10 @@ class Settings(BaseSettings):
     DOWNLOAD_TIMEOUT: int = 3600000
     MAX_CONCURRENT_COURSE_FETCH: int = 6
     MAX_CONCURRENT_DOWNLOADS: int = 4
+    MAX_CONCURRENT_COURSES: int = 3
+    CONTEXT_RECYCLE_EVERY: int = 3
+    DOWNLOAD_SPLITS: int = 8
+    KEEP_RARS: bool = False
     LOG_LEVEL: str = "INFO"
 
     class Config:
@@ -80,6 +129,122 @@ class Settings(BaseSettings):
         env_file_encoding = "utf-8"
 
 
+# Single Settings instance: each instantiation re-reads .env and re-runs
+# pydantic validation, so everything below shares this one.
+SETTINGS = Settings()
+
+# Configure the log level once at import; every field on Settings has a
+# default, so no getattr fallbacks are needed anywhere.
+logger.setLevel(getattr(logging, SETTINGS.LOG_LEVEL.upper(), logging.INFO))
+
+# Default timeouts, overridable in main() once CLI args are parsed.
+TIMEOUT_PAGE_LOAD = SETTINGS.TIMEOUT_PAGE_LOAD
+DOWNLOAD_TIMEOUT = SETTINGS.DOWNLOAD_TIMEOUT
+
+# Loop-bound primitives are created in main(): constructing them at import
+# binds get_event_loop()'s loop on Python <= 3.9 and then fails inside
+# asyncio.run(), and the README supports 3.8+.
+#
+# DOWNLOAD_SEM throttles concurrent downloads: each download holds one slot
+# for the duration of its retry loop so a large course cannot oversubscribe
+# the browser. COURSE_SEM bounds how many courses are being processed at
+# once; the download semaphore still limits total in-flight downloads.
+DOWNLOAD_SEM: Optional[asyncio.Semaphore] = None
+COURSE_SEM: Optional[asyncio.Semaphore] = None
+
+# Pool of pre-warmed download pages, populated in main() once the browser context
+# exists. Reusing pages avoids paying Chromium page creation/teardown per file.
+PAGE_POOL: Optional[asyncio.Queue] = None
+
+# Pool of pages for course processing, sized to MAX_CONCURRENT_COURSES. Pages
+# under the one authenticated context are far cheaper than extra contexts and
+# share the login cookies for free.
+COURSE_PAGE_POOL: Optional[asyncio.Queue] = None
+
+# Serializes context teardown/creation so concurrent callers never race a
+# recycle; created in main() alongside the semaphores (see note above)
+_CONTEXT_LOCK: Optional[asyncio.Lock] = None
+
+
+def _fill_page_pool() -> None:
+    """(Re)create the page pools; pages are added by the caller."""
+    global PAGE_POOL, COURSE_PAGE_POOL
+    PAGE_POOL = asyncio.Queue()
+    COURSE_PAGE_POOL = asyncio.Queue()
+
+
+async def recycle_context(browser, old_context: BrowserContext, state: dict, pool_size: int) -> BrowserContext:
+    """Close the context and start a fresh one with the saved auth state.
+
+    Chromium accumulates per-page Request/Response heap for the lifetime of a
+    context, so a long all-courses run grows monotonically; closing the
+    context every few courses keeps the working set flat. Re-warms the
+    download page pool on the new context.
+    """
+    async with _CONTEXT_LOCK:
+        try:
+            await old_context.close()
+        except Exception as e:
+            logger.warning(f"Error closing context during recycle: {e}")
+        context = await browser.new_context(storage_state=state, accept_downloads=True)
+        context.set_default_navigation_timeout(TIMEOUT_PAGE_LOAD)
+        _fill_page_pool()
+        for _ in range(pool_size):
+            PAGE_POOL.put_nowait(await context.new_page())
+        for _ in range(SETTINGS.MAX_CONCURRENT_COURSES):
+            COURSE_PAGE_POOL.put_nowait(await context.new_page())
+        logger.info("Recycled browser context to bound memory growth.")
+        return context
+
+
+async def acquire_download_page(context: BrowserContext) -> Page:
+    """Borrow a page from PAGE_POOL, or open a fresh one if the pool is not set up."""
+    if PAGE_POOL is not None:
+        return await PAGE_POOL.get()
+    return await context.new_page()
+
+
+async def acquire_course_page(context: BrowserContext) -> Page:
+    """Borrow a page from COURSE_PAGE_POOL, or open a fresh one if unset."""
+    if COURSE_PAGE_POOL is not None:
+        return await COURSE_PAGE_POOL.get()
+    return await context.new_page()
+
+
+async def release_course_page(context: BrowserContext, page: Page) -> None:
+    """Return a page to COURSE_PAGE_POOL, replacing it with a new one if it crashed."""
+    if COURSE_PAGE_POOL is None:
+        try:
+            await page.close()
+        except Exception:
+            pass
+        return
+    if page.is_closed():
+        try:
+            page = await context.new_page()
+        except PlaywrightError as e:
+            logger.warning(f"Could not replace crashed course page: {e}")
+            return
+    COURSE_PAGE_POOL.put_nowait(page)
+
+
+async def release_download_page(context: BrowserContext, page: Page) -> None:
+    """Return a page to PAGE_POOL, replacing it with a new one if it crashed."""
+    if PAGE_POOL is None:
+        try:
+            await page.close()
+        except Exception:
+            pass
+        return
+    if page.is_closed():
+        try:
+            page = await context.new_page()
+        except PlaywrightError as e:
+            logger.warning(f"Could not replace crashed download page: {e}")
+            return
+    PAGE_POOL.put_nowait(page)
+
+
 def prompt_if_none(val, prompt_text, is_password=False):
     if val:
         return val
@@ -89,6 +254,30 @@ def prompt_if_none(val, prompt_text, is_password=False):
     return input(prompt_text)
 
 
+# Static assets we never use on scraping-only pages. Download/popup pages are
+# left untouched: their click targets can depend on CSS being applied.
+_BLOCKED_URL_PATTERNS = ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.woff*', '*.css']
+
+
+async def _block_static_resources(page: Page) -> None:
+    """Block images/fonts/CSS on a scraping page via a CDP session.
+
+    Network.setBlockedURLs keeps the filtering inside the browser process, so
+    unlike page.route there is no per-request Python round-trip and no routing
+    state accumulating over a long crawl. Best-effort: non-Chromium browsers
+    simply load the page as-is, and the session detaches with the page.
+    """
+    if getattr(page, '_assets_blocked', False):
+        return  # pooled page: the CDP session from its first use still applies
+    try:
+        client = await page.context.new_cdp_session(page)
+        await client.send('Network.enable')
+        await client.send('Network.setBlockedURLs', {'urls': _BLOCKED_URL_PATTERNS})
+        page._assets_blocked = True
+    except Exception as e:
+        logger.debug("CDP resource blocking unavailable: %s", e)
+
+
 async def login(page: Page, username: str, password: str) -> None:
     """Automate login."""
     logger.info("Navigating to login page...")
@@ -104,8 +293,12 @@ async def login(page: Page, username: str, password: str) -> None:
     # Click the login button
     await page.click('#loginbtn')
     
-    # Wait for navigation or check if login successful
-    await page.wait_for_load_state('networkidle', timeout=TIMEOUT_PAGE_LOAD)
+    # Wait for the post-login redirect specifically instead of a load state:
+    # the dashboard URL appearing is the success signal we actually need.
+    try:
+        await page.wait_for_url(re.compile(r'/my/?($|\?)|/dashboard'), timeout=30000)
+    except Exception:
+        pass  # fall through to the URL check for the failure message
     
     # Check if login failed
     if "login" in page.url.lower():
@@ -120,45 +313,51 @@ async def get_course_ids(context: BrowserContext, page: Page, max_workers: int =
     """
     courses_url = f"{BASE_URL}/my/courses.php"
     logger.info(f"Navigating to courses page: {courses_url}")
+    await _block_static_resources(page)
     await page.goto(courses_url, timeout=TIMEOUT_PAGE_LOAD)
-    await page.wait_for_load_state('networkidle', timeout=TIMEOUT_PAGE_LOAD)
+    # goto already waited for 'load'; the course divs are the only thing we
+    # need next, so wait for those directly rather than any load state.
+    try:
+        await page.wait_for_selector('div[data-course-id]', timeout=10000)
+    except Exception:
+        logger.warning("No course elements appeared within 10s; continuing with whatever is present.")
 
     logger.info("Querying course elements on courses page...")
-    course_elements = await page.query_selector_all('div[data-course-id]')
-    logger.info(f"Found {len(course_elements)} course elements.")
-    
+    # Collect every course's id, anchor text and sr-only span texts in a single
+    # in-browser pass instead of one Playwright round-trip per element/span.
+    raw_courses = await page.evaluate(
+        """() => Array.from(document.querySelectorAll('div[data-course-id]')).map(elem => {
+            const anchor = elem.querySelector('a.aalink.coursename');
+            return {
+                course_id: elem.getAttribute('data-course-id'),
+                anchor_text: anchor ? (anchor.textContent || '') : null,
+                sr_only: anchor
+                    ? Array.from(anchor.querySelectorAll('span.sr-only')).map(s => (s.textContent || '').trim())
+                    : [],
+            };
+        })"""
+    )
+    logger.info(f"Found {len(raw_courses)} course elements.")
+
     # First, collect course_id and course_name without navigating
     course_list = list()
-    for idx, elem in enumerate(course_elements, 1):
+    for idx, raw in enumerate(raw_courses, 1):
         try:
-            course_id = await elem.get_attribute('data-course-id')
+            course_id = raw['course_id']
             logger.info(f"[{idx}] Extracted course_id: {course_id}")
             if course_id:
-                # Find the anchor with class 'aalink coursename'
-                anchor = await elem.query_selector('a.aalink.coursename')
-                if anchor:
-                    # Get all child nodes, ignore sr-only spans
-                    # Get all spans with class 'sr-only' inside anchor
-                    sr_only_spans = await anchor.query_selector_all('span.sr-only')
-                    sr_only_texts = set()
-                    for span in sr_only_spans:
-                        txt = (await span.text_content()) or ""
-                        sr_only_texts.add(txt.strip())
-                    # Get all child nodes (text nodes and spans)
-                    # Use regex to extract all text nodes not inside sr-only spans
-                    # This is robust for Playwright, but if you want to use JSHandle, you can use anchor.evaluate
-                    # For now, let's use text_content and remove unwanted phrases
-                    anchor_text = (await anchor.text_content()) or ""
+                anchor_text = raw['anchor_text']
+                if anchor_text is not None:
                     anchor_text = anchor_text.strip()
                     # Remove all sr-only texts and unwanted phrases
-                    for unwanted in list(sr_only_texts) + ["درس ستاره‌دار شده است", "نام درس"]:
+                    for unwanted in list(set(raw['sr_only'])) + ["درس ستاره‌دار شده است", "نام درس"]:
                         anchor_text = anchor_text.replace(unwanted, "")
                     # Remove parentheses and their contents
-                    course_name = re.sub(r'\([^)]*\)', '', anchor_text)
+                    course_name = _PAREN_STRIP.sub('', anchor_text)
                     # Remove all digits
-                    course_name = re.sub(r'\d+', '', course_name)
+                    course_name = _DIGITS.sub('', course_name)
                     # Remove extra whitespace
-                    course_name = re.sub(r'\s+', ' ', course_name).strip()
+                    course_name = _WS.sub(' ', course_name).strip()
                     # Replace spaces with underscores
                     course_name = course_name.replace(' ', '_')
                     course_name = sanitize_filename(course_name)
@@ -181,28 +380,21 @@ async def get_course_ids(context: BrowserContext, page: Page, max_workers: int =
         async with sem:
             try:
                 course_page_url = f"{BASE_URL}/course/view.php?id={course_id}"
-                logger.info(f"[{idx}] Navigating to course page: {course_page_url}")
-                page2 = await context.new_page()
-                try:
-                    await page2.goto(course_page_url, timeout=TIMEOUT_PAGE_LOAD)
-                    # Wait for either the module list or a fallback element that indicates the page is loaded
-                    await page2.wait_for_selector('li[id^="module-"]', timeout=10000)
-                    # Find the onlineclass module anchor; prefer full absolute link and search for query param id
-                    onlineclass_link = await page2.query_selector('a[href*="/mod/onlineclass/view.php?id="]')
-                    onlineclass_id = None
-                    if onlineclass_link:
-                        href = await onlineclass_link.get_attribute('href')
-                        logger.info(f"[{idx}] Found onlineclass link: {href}")
-                        if href:
-                            m = re.search(r'/mod/onlineclass/view\.php\?id=(\d+)', href)
-                            if m:
-                                onlineclass_id = m.group(1)
-                                logger.info(f"[{idx}] Extracted onlineclass_id: {onlineclass_id}")
-                    if onlineclass_id:
-                        return (course_id, course_name, onlineclass_id)
-                    logger.warning(f"[{idx}] No onlineclass module found for course {course_id} ({course_name})")
-                finally:
-                    await page2.close()
+                logger.info(f"[{idx}] Fetching course page: {course_page_url}")
+                # The course page is only grepped for the onlineclass link, so
+                # fetch it over the context's request API (same cookie jar)
+                # instead of rendering a full Chromium tab per course.
+                resp = await context.request.get(course_page_url, timeout=TIMEOUT_PAGE_LOAD)
+                if not resp.ok:
+                    logger.warning(f"[{idx}] Course page returned HTTP {resp.status} for course {course_id}")
+                    return None
+                html = await resp.text()
+                m = _ONLINECLASS_RE.search(html)
+                if m:
+                    onlineclass_id = m.group(1)
+                    logger.info(f"[{idx}] Extracted onlineclass_id: {onlineclass_id}")
+                    return (course_id, course_name, onlineclass_id)
+                logger.warning(f"[{idx}] No onlineclass module found for course {course_id} ({course_name})")
             except Exception as e:
                 logger.error(f"[{idx}] Error extracting onlineclass_id for course {course_id}: {e}")
             return None
@@ -224,154 +416,198 @@ async def process_course(context: BrowserContext, course_id: str, downloads_dir:
     # Initialize downloaded entry for the course if not present
     if folder_name not in downloaded:
         downloaded[folder_name] = {
-            "rars": [],
-            "mp4s": [],
+            "rars": set(),
+            "mp4s": set(),
             "download_folder": str(downloads_dir / folder_name),
             "extract_folder": str(course_dir)
         }
-        save_downloaded(downloaded)
+        save_downloaded(downloaded, folder_name)
+
+    # Reconcile the manifest with disk once per course; afterwards the mp4s
+    # set is the source of truth and per-file .exists() stats are skipped.
+    if course_dir.is_dir():
+        with os.scandir(course_dir) as it:
+            downloaded[folder_name]["mp4s"].update(
+                entry.name for entry in it if entry.name.endswith('.mp4')
+            )
+
+    # Create the course download folder once instead of per rar file
+    (downloads_dir / folder_name).mkdir(parents=True, exist_ok=True)
     
-    page = await context.new_page()
-    try:
-        # Use the correct onlineclass_id for recordings. Navigate to the recording list directly to reduce steps.
-        recording_url = f"{BASE_URL}/mod/onlineclass/view.php?id={onlineclass_id}&action=recording.list"
-        logger.info(f"Navigating to recording list: {recording_url}")
-        await page.goto(recording_url, timeout=TIMEOUT_PAGE_LOAD)
-        # Wait for the list container's existence rather than networkidle
+    async with COURSE_SEM:
+        page = await acquire_course_page(context)
         try:
-            await page.wait_for_selector('a[href*="action=recording.view"], a[href*="offline.sbu.ac.ir"]', timeout=15000)
-        except Exception:
-            # fallback to generic waiting
-            await page.wait_for_load_state('load', timeout=TIMEOUT_PAGE_LOAD)
-
-        # Locate all offline links directly. Search for anchors that point to offline.sbu.ac.ir as a reliable identifier.
-        logger.info("Locating recording items with offline links...")
-        offline_anchors = await page.query_selector_all("a[href^=\"https://offline.sbu.ac.ir\"]")
-        if not offline_anchors:
-            # fallback: find anchors whose href contain 'action=recording.view' or text 'لینک آفلاین'
-            offline_anchors = await page.query_selector_all("a[href*='action=recording.view'], a:has-text('لینک آفلاین')")
-        if not offline_anchors:
-            logger.warning(f"Recording list not found for course {course_id}.")
-            return
-        # Each anchor is contained in an li; gather li parent nodes
-        lis = list()
-        for a in offline_anchors:
-            # Find the parent li for each offline anchor
-            li_handle = await a.evaluate_handle('el => el.closest("li")')
-            li_elem = li_handle.as_element() if li_handle else None
-            if li_elem:
-                lis.append(li_elem)
-        logger.info(f"Found {len(lis)} offline recordings to process for course {course_id}.")
-
-        if not lis:
-            logger.warning(f"No offline recordings found for course {course_id}. Skipping.")
-            return
+            # Use the correct onlineclass_id for recordings. Navigate to the recording list directly to reduce steps.
+            recording_url = f"{BASE_URL}/mod/onlineclass/view.php?id={onlineclass_id}&action=recording.list"
+            logger.info(f"Navigating to recording list: {recording_url}")
+            await _block_static_resources(page)
+            await page.goto(recording_url, timeout=TIMEOUT_PAGE_LOAD)
+            # Wait for the list container's existence rather than networkidle
+            try:
+                await page.wait_for_selector('a[href*="action=recording.view"], a[href*="offline.sbu.ac.ir"]', timeout=15000)
+            except Exception:
+                # fallback to generic waiting
+                await page.wait_for_load_state('load', timeout=TIMEOUT_PAGE_LOAD)
+
+            # Locate all offline links directly. Search for anchors that point to offline.sbu.ac.ir as a reliable identifier.
+            logger.info("Locating recording items with offline links...")
+            offline_anchors = await page.query_selector_all("a[href^=\"https://offline.sbu.ac.ir\"]")
+            if not offline_anchors:
+                # fallback: find anchors whose href contain 'action=recording.view' or text 'لینک آفلاین'
+                offline_anchors = await page.query_selector_all("a[href*='action=recording.view'], a:has-text('لینک آفلاین')")
+            if not offline_anchors:
+                logger.warning(f"Recording list not found for course {course_id}.")
+                return
+            # Each anchor is contained in an li; grab every anchor's parent li
+            # HTML plus href/text in ONE evaluate over all handles, so a course
+            # with N recordings costs one protocol round-trip instead of N. The
+            # handles themselves are kept for the popup clicks below.
+            infos = await page.evaluate(
+                'els => els.map(el => { const li = el.closest("li");'
+                ' return { li: li ? li.outerHTML : "",'
+                ' href: el.getAttribute("href") || "",'
+                ' text: el.textContent || "" }; })',
+                offline_anchors
+            )
+            lis = [(a, info) for a, info in zip(offline_anchors, infos) if info['li']]
+            logger.info(f"Found {len(lis)} offline recordings to process for course {course_id}.")
+
+            if not lis:
+                logger.warning(f"No offline recordings found for course {course_id}. Skipping.")
+                return
 
-        # throttle downloads per course
-        max_downloads = getattr(Settings(), 'MAX_CONCURRENT_DOWNLOADS', 4)
-        download_sem = asyncio.Semaphore(max_downloads)
-
-        # Process each valid recording
-        tasks = list()
-        page_click_lock = asyncio.Lock()
-        for idx, li_handle in enumerate(lis, start=1):
-            li_html = await li_handle.inner_html()
-            res_outer = await parse_li(li_html, idx)
-            expected_filename = res_outer[1] if res_outer else None
-            logger.info(f"Processing item #{idx}, expected filename: {expected_filename}")
-            # Prefer clicking the offline link inside the li if present
-            offline_anchor = await li_handle.query_selector("a[href^='https://offline.sbu.ac.ir'], a:has-text('لینک آفلاین')")
-            if offline_anchor:
-                # click and wait for popup
-                # Build a task to handle the popup click + download so we can process many concurrently
-                async def popup_download_task(li=li_handle, index=idx, _offline_anchor=offline_anchor):
-                    rar_filename = None
-                    mp4_filename_local = None
-                    try:
-                        # compute candidate filename from li content
-                        res = await parse_li(await li.inner_html(), index)
-                        if res:
-                            href, filename = res
-                            rar_filename = filename
-                            mp4_filename_local = filename.replace('.rar', '.mp4')
-                            if mp4_filename_local in downloaded[folder_name]["mp4s"]:
-                                logger.info(f"Already extracted: {mp4_filename_local}")
-                                return
-                        async with download_sem:
-                            async with page_click_lock:
-                                async with page.expect_popup(timeout=15000) as popup_info:
-                                    logger.info(f"Clicking offline link to open popup for index {index} (filename: {rar_filename})")
-                                    await _offline_anchor.click()
-                            popup = await popup_info.value
+            # Short-circuit when the recording items themselves are unchanged
+            # since the last fully-processed run. Hash only the li elements we
+            # actually parse: the full rendered page embeds per-session markup
+            # (sesskey URLs, YUI config) that differs on every login and would
+            # never match.
+            list_hash = hashlib.blake2b(
+                ''.join(info['li'] for _, info in lis).encode(), digest_size=16
+            ).hexdigest()
+            if downloaded[folder_name].get("list_hash") == list_hash:
+                logger.info(f"Recording list unchanged for course {course_id}; skipping parse and downloads.")
+                return
+
+            # Process each valid recording. Popup items run in two phases:
+            # the sequential loop below opens each popup right away (a click is
+            # ~100 ms, and popups must be attributed to their click one at a
+            # time on a single page anyway), then the download workers drain
+            # the open popups concurrently under DOWNLOAD_SEM. Compared to the
+            # old in-task click lock, a slow download can no longer block the
+            # next item's click.
+            tasks = list()
+            extract_tasks = list()
+            clean_pass = True
+
+            async def popup_download_worker(popup, res, index):
+                rar_filename = res[1] if res else f"{index:02d}.rar"
+                mp4_filename_local = rar_filename.replace('.rar', '.mp4') if res else None
+                rar_path_local = downloads_dir / folder_name / rar_filename
+                try:
+                    async with DOWNLOAD_SEM:
+                        try:
+                            logger.info(f"Starting popup download for {rar_filename} -> {rar_path_local}")
+                            await trigger_download_on_page(popup, rar_path_local, DOWNLOAD_TIMEOUT)
+                            # Log size after saving
                             try:
-                                if not rar_filename:
-                                    rar_filename = f"{index:02d}.rar"
-                                rar_path_local = downloads_dir / folder_name / rar_filename
-                                logger.info(f"Starting popup download for {rar_filename} -> {rar_path_local}")
-                                await trigger_download_on_page(popup, rar_path_local, DOWNLOAD_TIMEOUT)
-                                # Log size after saving
-                                try:
-                                    size = rar_path_local.stat().st_size
-                                    logger.info(f"Popup download completed: {rar_path_local} ({size} bytes)")
-                                except Exception:
-                                    logger.info(f"Popup download completed: {rar_path_local}")
-                            finally:
-                                try:
-                                    await popup.close()
-                                except Exception:
-                                    pass
-                            # Attempt extraction and register
-                            if res and mp4_filename_local:
-                                logger.info(f"Extracting downloaded rar to generate {mp4_filename_local}")
-                                extract_rar(downloads_dir / folder_name / rar_filename, course_dir)
-                                if (course_dir / mp4_filename_local).exists():
-                                    if mp4_filename_local not in downloaded[folder_name]["mp4s"]:
-                                        downloaded[folder_name]["mp4s"].append(mp4_filename_local)
-                                        save_downloaded(downloaded)
+                                size = rar_path_local.stat().st_size
+                                logger.info(f"Popup download completed: {rar_path_local} ({size} bytes)")
+                            except Exception:
+                                logger.info(f"Popup download completed: {rar_path_local}")
+                        finally:
+                            try:
+                                await popup.close()
+                            except Exception:
+                                pass
+                        # Schedule extraction in the background so the
+                        # download slot frees immediately
+                        if mp4_filename_local:
+                            logger.info(f"Scheduling extraction of {rar_filename} -> {mp4_filename_local}")
+                            extract_tasks.append(schedule_extract(rar_path_local, course_dir, downloaded, folder_name, mp4_filename_local))
+                except Exception as e:
+                    logger.warning(f"Failed popup download task for item #{index}: {e}")
+                    return e
+
+            for idx, (anchor, info) in enumerate(lis, start=1):
+                li_html = info['li']
+                res_outer = await parse_li(li_html, idx)
+                expected_filename = res_outer[1] if res_outer else None
+                logger.info(f"Processing item #{idx}, expected filename: {expected_filename}")
+                # Prefer clicking the offline link if it opens the popup flow
+                is_popup_anchor = info['href'].startswith('https://offline.sbu.ac.ir') or 'لینک آفلاین' in info['text']
+                if is_popup_anchor:
+                    if res_outer and res_outer[1].replace('.rar', '.mp4') in downloaded[folder_name]["mp4s"]:
+                        logger.info(f"Already extracted: {res_outer[1].replace('.rar', '.mp4')}")
+                        continue
+                    try:
+                        async with page.expect_popup(timeout=15000) as popup_info:
+                            logger.info(f"Clicking offline link to open popup for index {idx} (filename: {expected_filename})")
+                            await anchor.click()
+                        popup = await popup_info.value
                     except Exception as e:
-                        logger.warning(f"Failed popup download task for item #{index}: {e}")
-                logger.info(f"Scheduling popup download task for item #{idx} -> {expected_filename or 'unknown'}")
-                tasks.append(popup_download_task())
-                continue
-            # Fallback to parse_li href navigation if there's no offline anchor
-            result = await parse_li(li_html, idx)
-            if not result:
-                continue
-            href, filename = result
-            mp4_filename = filename.replace('.rar', '.mp4')
-            if mp4_filename in downloaded[folder_name]["mp4s"]:
-                logger.info(f"Already extracted: {mp4_filename}")
-                continue
-            # wrap download to acquire semaphore
-            async def download_task(href=href, filename=filename, mp4_filename=mp4_filename):
-                await download_sem.acquire()
-                try:
-                    await download_and_extract(context, href, filename, downloads_dir, course_dir, downloaded, folder_name, mp4_filename)
-                finally:
-                    download_sem.release()
-
-            logger.info(f"Scheduling direct download task for item #{idx} -> {filename}")
-            tasks.append(download_task())
-
-        # Run downloads concurrently
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        # Log exceptions from concurrent tasks
-        for r in results:
-            if isinstance(r, Exception):
-                logger.warning(f"Background task returned exception: {r}")
-
-        logger.info(f"Completed processing course {course_id}.")
+                        logger.warning(f"Failed to open popup for item #{idx}: {e}")
+                        clean_pass = False
+                        continue
+                    tasks.append(popup_download_worker(popup, res_outer, idx))
+                    continue
+                # Fallback to parse_li href navigation if there's no offline anchor
+                result = res_outer
+                if not result:
+                    continue
+                href, filename = result
+                mp4_filename = filename.replace('.rar', '.mp4')
+                if mp4_filename in downloaded[folder_name]["mp4s"]:
+                    logger.info(f"Already extracted: {mp4_filename}")
+                    continue
+                # download_and_extract acquires DOWNLOAD_SEM internally
+                logger.info(f"Scheduling direct download task for item #{idx} -> {filename}")
+                tasks.append(download_and_extract(context, href, filename, downloads_dir, course_dir, downloaded, folder_name, mp4_filename, extract_tasks))
+
+            # Run downloads concurrently
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            # Log exceptions from concurrent tasks
+            for r in results:
+                if isinstance(r, Exception):
+                    logger.warning(f"Background task returned exception: {r}")
+
+            # Drain this course's extractions before judging the pass;
+            # download slots free as soon as bytes land, extraction trails
+            # behind. Only our own tasks are awaited — gathering the global
+            # registry would steal results from concurrently-running courses.
+            extract_results = list()
+            if extract_tasks:
+                extract_results = await asyncio.gather(*extract_tasks, return_exceptions=True)
+                for r in extract_results:
+                    if isinstance(r, Exception):
+                        logger.warning(f"Extraction task returned exception: {r}")
+
+            # Remember the list hash only after a clean pass: no failed popup
+            # clicks, no worker exceptions (returned, not raised), and no
+            # items deferred with False because the LMS is still preparing
+            # them — the list page doesn't change when a file becomes ready,
+            # so a cached hash would skip it forever.
+            unclean = not clean_pass or any(
+                isinstance(r, Exception) or r is False
+                for r in list(results) + extract_results
+            )
+            if not unclean:
+                downloaded[folder_name]["list_hash"] = list_hash
+                save_downloaded(downloaded, folder_name)
+
+            logger.info(f"Completed processing course {course_id}.")
 
-    except Exception as e:
-        logger.error(f"Error processing course {course_id}: {e}")
-    finally:
-        await page.close()
+        except Exception as e:
+            logger.error(f"Error processing course {course_id}: {e}")
+        finally:
+            await release_course_page(context, page)
 
 
 async def parse_li(li_html: str, idx: int) -> Optional[tuple[str, str]]:
     """Extract offline link, index, and datetime from li HTML."""
-    logger.debug(f"Parsing item #{idx}...")
-    href_m = re.search(r'<a[^>]+href=["\']([^"\']+)["\'][^>]*>.*?آفلاین', li_html, re.S)
+    logger.debug("Parsing item #%d...", idx)
+    # Normalize any Persian digits up front; everything below assumes ASCII
+    li_html = li_html.translate(_DIGIT_TRANS)
+    href_m = _HREF_RE.search(li_html)
     if not href_m:
         logger.warning(f"No offline link in item #{idx}.")
         return None
@@ -381,10 +617,10 @@ async def parse_li(li_html: str, idx: int) -> Optional[tuple[str, str]]:
         href = BASE_URL + href
 
     # find the datetime parentheses containing a Persian month
-    all_parens = re.findall(r"\(([^)]+)\)", li_html)
+    all_parens = _PARENS_RE.findall(li_html)
     dt_parts = None
     for part in all_parens:
-        if any(mon in part for mon in PERSIAN_MONTHS):
+        if _HAS_MONTH.search(part):
             dt_parts = [p.strip() for p in part.split('،')]
             break
     if not dt_parts or len(dt_parts) < 3:
@@ -393,29 +629,116 @@ async def parse_li(li_html: str, idx: int) -> Optional[tuple[str, str]]:
     date_part, time_part = dt_parts[1], dt_parts[2]
 
     # parse date
-    d_m = re.search(r"(\d+)\s+(\S+)\s+(\d+)", date_part)
+    d_m = _DATE_RE.search(date_part)
     if not d_m:
         logger.warning(f"Date parse failed in #{idx}, date_part={date_part}")
         return None
     day, mon_name, year = d_m.groups()
-    mon = PERSIAN_MONTHS.get(mon_name, '00')
+    mon = _MONTH_GET(mon_name, '00')
 
     # parse time
-    t_m = re.search(r"(\d+):(\d+)\s+(\S+)", time_part)
+    t_m = _TIME_RE.search(time_part)
     if not t_m:
         logger.warning(f"Time parse failed in #{idx}, time_part={time_part}")
         return None
     hour, minute, period = t_m.groups()
-    h = (int(hour) % 12) + PERIOD_OFFSET.get(period, 0)
+    h = (int(hour) % 12) + _PERIOD_GET(period, 0)
 
     idx_str = f"{idx:02d}"
     date_str = f"{year}-{mon}-{int(day):02d}"
     time_str = f"{h:02d}-{int(minute):02d}"
     filename = f"{idx_str}_{date_str}_{time_str}.rar"
-    logger.debug(f"href={href}, filename={filename}")
+    logger.debug("href=%s, filename=%s", href, filename)
     return href, filename
 
 
+def _detect_extractors() -> list:
+    """Locate extraction tools once at import time and pre-bake their argv.
+
+    shutil.which walks PATH with a stat() per candidate, so doing this per
+    rar file is wasted work. Returns commands to try in order of preference.
+    """
+    if platform.system() == "Windows":
+        seven_zip = shutil.which("7z") or (r"C:\\Program Files\\7-Zip\\7z.exe" if Path(r"C:\\Program Files\\7-Zip\\7z.exe").exists() else None)
+        unrar_exe = shutil.which("unrar") or (r"C:\\Program Files\\WinRAR\\WinRAR.exe" if Path(r"C:\\Program Files\\WinRAR\\WinRAR.exe").exists() else None)
+    else:
+        seven_zip = shutil.which("7z")
+        unrar_exe = shutil.which("unrar")
+    extractors = list()
+    if seven_zip:
+        # -mmt=on enables multi-threaded decompression; -bso0/-bsp0 silence output
+        extractors.append(lambda rar, out, exe=seven_zip: subprocess.run(
+            [exe, "x", str(rar), f"-o{out}", "-y", "-mmt=on", "-bso0", "-bsp0"], capture_output=True))
+    if unrar_exe:
+        # unrar syntax: unrar x -y rarfile destdir. -inul silences output and
+        # -mt<N> engages libunrar's worker threads on RAR5 archives.
+        extractors.append(lambda rar, out, exe=unrar_exe: subprocess.run(
+            [exe, "x", "-y", "-inul", f"-mt{os.cpu_count() or 1}", str(rar), str(out)], capture_output=True))
+    return extractors
+
+
+_EXTRACTORS = _detect_extractors()
+
+
+def _extract_mp4_libarchive(rar_path: Path, expected_mp4: Path) -> Optional[Path]:
+    """Stream the first .mp4 out of the archive in-process via libarchive.
+
+    Returns None when libarchive is missing or cannot read the archive (some
+    builds lack RAR5 support), so callers fall back to the subprocess tools.
+    Blocks are streamed to a .part file next to the target and renamed into
+    place only once the entry is fully written, so a crash mid-extract never
+    leaves a truncated .mp4 at a path the manifest reconcile would trust.
+    """
+    if _libarchive is None:
+        return None
+    part_path = expected_mp4.with_name(expected_mp4.name + '.part')
+    try:
+        with _libarchive.file_reader(str(rar_path)) as archive:
+            for entry in archive:
+                if str(entry.pathname).endswith('.mp4'):
+                    with open(part_path, 'wb') as out:
+                        for block in entry.get_blocks():
+                            out.write(block)
+                    os.replace(part_path, expected_mp4)
+                    return expected_mp4
+    except Exception as e:
+        logger.debug("libarchive could not extract %s: %s", rar_path, e)
+    try:
+        part_path.unlink()
+    except OSError:
+        pass
+    return None
+
+
+def _drop_cache(path: Path) -> None:
+    """Tell the kernel we won't re-read this file, so GB-scale archives and
+    videos stop crowding the page cache during long runs. No-op off Linux."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def _fast_move(src: Path, dst: Path) -> None:
+    """Move src to dst with os.rename, copying only when on different devices.
+
+    The cross-device fallback streams in 4 MiB blocks instead of shutil's
+    default 64 KiB, which matters for multi-GB recordings.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, length=4 * 1024 * 1024)
+        os.unlink(src)
+
+
 def extract_rar(rar_path: Path, output_dir: Path) -> Path:
     """Extract .rar file to output directory and return the .mp4 file path."""
     base_name = rar_path.stem
@@ -425,30 +748,24 @@ def extract_rar(rar_path: Path, output_dir: Path) -> Path:
         logger.info(f"MP4 already exists: {expected_mp4}")
         return expected_mp4
     
-    with tempfile.TemporaryDirectory() as tmpdir:
+    # In-process fast path first; no subprocess per archive
+    extracted = _extract_mp4_libarchive(rar_path, expected_mp4)
+    if extracted is not None:
+        logger.info(f"Extracted via libarchive to: {extracted}")
+        _drop_cache(rar_path)
+        _drop_cache(expected_mp4)
+        return extracted
+    
+    # Extract into a temp dir inside output_dir: /tmp may live on another
+    # device, which would turn the final shutil.move of a multi-GB video into
+    # a full copy instead of a cheap same-filesystem rename.
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmpdir:
         logger.info(f"Extracting {rar_path} to temp dir...")
-        system = platform.system()
         success = False
-        if system == "Windows":
-            seven_zip = shutil.which("7z") or (r"C:\\Program Files\\7-Zip\\7z.exe" if Path(r"C:\\Program Files\\7-Zip\\7z.exe").exists() else None)
-            unrar_exe = shutil.which("unrar") or (r"C:\\Program Files\\WinRAR\\WinRAR.exe" if Path(r"C:\\Program Files\\WinRAR\\WinRAR.exe").exists() else None)
-            if seven_zip:
-                if subprocess.run([seven_zip, "x", str(rar_path), f"-o{tmpdir}", "-y"], capture_output=True).returncode == 0:
-                    success = True
-            if not success and unrar_exe:
-                if subprocess.run([unrar_exe, "x", "-y", str(rar_path), tmpdir], capture_output=True).returncode == 0:
-                    success = True
-        else:
-            # Unix-like: try 7z and unrar from PATH
-            seven_zip = shutil.which("7z")
-            unrar_exe = shutil.which("unrar")
-            if seven_zip:
-                if subprocess.run([seven_zip, "x", str(rar_path), f"-o{tmpdir}", "-y"], capture_output=True).returncode == 0:
-                    success = True
-            if not success and unrar_exe:
-                # On Unix, unrar syntax: unrar x -y rarfile destdir
-                if subprocess.run([unrar_exe, "x", "-y", str(rar_path), tmpdir], capture_output=True).returncode == 0:
-                    success = True
+        for extractor in _EXTRACTORS:
+            if extractor(rar_path, tmpdir).returncode == 0:
+                success = True
+                break
         if not success:
             raise Exception(f"Failed to extract {rar_path}. Ensure 7z or unrar is installed and in PATH.")
         # Find the .mp4 file
@@ -458,117 +775,289 @@ def extract_rar(rar_path: Path, output_dir: Path) -> Path:
         if len(mp4_files) > 1:
             logger.warning(f"Multiple MP4 files found in {rar_path}, using first: {mp4_files[0]}")
         mp4_path = mp4_files[0]
-        shutil.move(mp4_path, expected_mp4)
+        # The temp dir sits inside output_dir, so this is an O(1) rename
+        _fast_move(mp4_path, expected_mp4)
         logger.info(f"Extracted and renamed to: {expected_mp4}")
+        # Both files were just streamed through the page cache; evict them
+        _drop_cache(rar_path)
+        _drop_cache(expected_mp4)
         return expected_mp4
 
 
-async def download_and_extract(context: BrowserContext, href: str, filename: str, downloads_dir: Path, extracted_dir: Path, downloaded: dict, folder_name: str, mp4_filename: str) -> None:
-    """Download a .rar file and extract it."""
-    (downloads_dir / folder_name).mkdir(parents=True, exist_ok=True)
+# RAR extraction blocks for minutes per file; run it in worker processes so
+# extractions overlap with ongoing downloads (and each other, across cores).
+_EXTRACT_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+
+
+async def extract_rar_async(rar_path: Path, output_dir: Path) -> Path:
+    """Run extract_rar in the extraction process pool without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_EXTRACT_POOL, extract_rar, rar_path, output_dir)
+
+
+# Strong references to in-flight extraction tasks so they aren't garbage
+# collected mid-run; each course drains its own tasks via the per-course
+# lists it passes around.
+_PENDING_EXTRACTS: set = set()
+
+
+def schedule_extract(rar_path: Path, output_dir: Path, downloaded: dict, folder_name: str, mp4_filename: str) -> asyncio.Task:
+    """Queue extraction + manifest registration without holding up the caller."""
+    async def _extract_job():
+        await extract_rar_async(rar_path, output_dir)
+        try:
+            extracted_ok = (output_dir / mp4_filename).stat().st_size > 0
+        except OSError:
+            extracted_ok = False
+        if extracted_ok:
+            if mp4_filename not in downloaded[folder_name]["mp4s"]:
+                downloaded[folder_name]["mp4s"].add(mp4_filename)
+                save_downloaded(downloaded, folder_name)
+            # The archive is redundant once the video is confirmed on disk;
+            # keeping it doubles the per-course footprint. KEEP_RARS=True
+            # preserves the old keep-everything behaviour.
+            if not SETTINGS.KEEP_RARS:
+                try:
+                    rar_path.unlink()
+                except OSError:
+                    pass
+
+    task = asyncio.create_task(_extract_job())
+    _PENDING_EXTRACTS.add(task)
+    task.add_done_callback(_PENDING_EXTRACTS.discard)
+    return task
+
+
+async def _head_validator(context: BrowserContext, file_url: str) -> Optional[str]:
+    """HEAD the file URL and return its ETag (or Last-Modified) validator."""
+    try:
+        head = await context.request.head(file_url, timeout=30000)
+        return head.headers.get('etag') or head.headers.get('last-modified')
+    except Exception:
+        return None
+
+
+async def download_via_request(context: BrowserContext, href: str, rar_path: Path,
+                               downloaded: Optional[dict] = None, folder_name: Optional[str] = None) -> Optional[bool]:
+    """Resolve the direct file URL via context.request and download with aria2c.
+
+    Fetching the small landing page through the APIRequestContext shares the
+    browser's cookie jar but skips two full Chromium page loads per file.
+    When the manifest is passed in, the file URL is HEAD-prechecked first: a
+    matching stored ETag/Last-Modified means the .rar on disk is current and
+    the download is skipped outright.
+    Returns True when the file was downloaded (or is verifiably current on
+    disk), False to fall back to the browser flow, and None when the LMS
+    reports the file is still being prepared (callers should skip the item).
+    """
+    if not _ARIA2C:
+        # Without aria2c we'd have to buffer multi-GB bodies in memory;
+        # the browser download flow streams to disk instead.
+        return False
+    resp = await context.request.get(href)
+    if not resp.ok:
+        return False
+    if 'text/html' not in resp.headers.get('content-type', ''):
+        return False
+    html = await resp.text()
+    if "فایل آفلاین این جلسه در حال آماده سازی است" in html:
+        return None
+    for m in _ANCHOR_HREF_RE.finditer(html):
+        file_url = urljoin(href, m.group(1))
+        if file_url.startswith('http') and ('mp4-' in file_url or file_url.endswith(('.rar', '.mp4'))):
+            entry = downloaded.get(folder_name) if downloaded is not None else None
+            validator = await _head_validator(context, file_url) if entry is not None else None
+            if validator is not None:
+                prev = entry.setdefault('etags', {}).get(rar_path.name)
+                if prev == validator and rar_path.exists() and rar_path.stat().st_size > 0:
+                    logger.info(f"{rar_path.name} unchanged on server (validator match); reusing local file.")
+                    return True
+            ok = await download_via_aria2c(context, file_url, rar_path, DOWNLOAD_TIMEOUT)
+            if ok and validator is not None:
+                entry['etags'][rar_path.name] = validator
+                save_downloaded(downloaded, folder_name)
+            return ok
+    return False
+
+
+async def download_and_extract(context: BrowserContext, href: str, filename: str, downloads_dir: Path, extracted_dir: Path, downloaded: dict, folder_name: str, mp4_filename: str, extract_tasks: Optional[list] = None) -> bool:
+    """Download a .rar file and extract it.
+
+    The per-course download folder is created once by process_course. The
+    scheduled extraction task is appended to `extract_tasks` when given, so
+    the caller can drain its own course's extractions. Returns True when the
+    item is done or its extraction has been scheduled, and False when it was
+    deferred because the LMS is still preparing the offline file — callers
+    must treat False as an incomplete pass.
+    """
     rar_path = downloads_dir / folder_name / filename
     
+    # Trust the (disk-reconciled) manifest first; only stat on a cache miss
+    if mp4_filename in downloaded[folder_name]["mp4s"]:
+        logger.info(f"MP4 already exists for {filename}, skipping.")
+        return True
     if (extracted_dir / mp4_filename).exists():
         logger.info(f"MP4 already exists for {filename}, skipping.")
-        if mp4_filename not in downloaded[folder_name]["mp4s"]:
-            downloaded[folder_name]["mp4s"].append(mp4_filename)
-            save_downloaded(downloaded)
-        return
+        downloaded[folder_name]["mp4s"].add(mp4_filename)
+        save_downloaded(downloaded, folder_name)
+        return True
     
     logger.info(f"Downloading {filename}...")
     logger.info(f"Starting direct download: {filename} -> {href} (will save to {rar_path})")
     max_retries = 3
-    for attempt in range(max_retries):
-        dl_page = await context.new_page()
+    async with DOWNLOAD_SEM:
+        # Fast path: resolve the landing page over context.request and pull
+        # the bytes with aria2c; fall back to the browser flow on any miss
+        fetched = False
         try:
-            logger.info(f"Opening download page for {filename}: {href}")
-            try:
-                await dl_page.goto(href, timeout=TIMEOUT_PAGE_LOAD)
-            except Exception as e:
-                logger.warning(f"Goto failed for {href}: {e}; attempting click navigation instead")
-                # Try to open via navigation by clicking a link from the parent page if available
-                raise
-            page_text = await dl_page.inner_text('body')
-            if "فایل آفلاین این جلسه در حال آماده سازی است" in page_text:
+            result = await download_via_request(context, href, rar_path, downloaded, folder_name)
+            if result is None:
                 logger.warning(f"The offline file for {filename} is being prepared. Please run the script again in a few hours.")
-                return
-            # Try multiple selector strategies for the actual downloadable file link.
-            # Prefer direct .rar or .mp4 links; otherwise try download labels in English or Persian.
-            # Try to directly trigger the download on this page
+                return False
+            fetched = result
+        except Exception as e:
+            logger.info(f"context.request fast path failed for {filename}: {e}; using browser flow")
+        if not fetched:
+            dl_page = await acquire_download_page(context)
             try:
-                await trigger_download_on_page(dl_page, rar_path, DOWNLOAD_TIMEOUT)
-            except Exception as e:
-                logger.info(f"Direct download on page failed: {e}; trying to follow an offline link or handle popup")
-                # Try to find 'لینک آفلاین' anchor and follow it
-                alt_anchor = await dl_page.query_selector("a:has-text('لینک آفلاین'), a[href^=\"https://offline.sbu.ac.ir\"]")
-                if alt_anchor:
+                for attempt in range(max_retries):
+                    # A failed attempt may have crashed/closed the pooled page; replace it
+                    if dl_page.is_closed():
+                        dl_page = await context.new_page()
                     try:
-                        async with dl_page.expect_popup(timeout=5000) as popup_info:
-                            await alt_anchor.click()
-                        popup = await popup_info.value
+                        logger.info(f"Opening download page for {filename}: {href}")
                         try:
-                            await trigger_download_on_page(popup, rar_path, DOWNLOAD_TIMEOUT)
-                        finally:
-                            try:
-                                await popup.close()
-                            except Exception:
-                                pass
-                    except Exception as e2:
-                        logger.warning(f"Popup download fallback failed: {e2}")
-                        raise
-                else:
-                    raise
-            else:
-                # If no download candidate, try to trigger a navigation to the actual file (some pages have a link inside a button)
-                # Try to find any anchor with 'آفلاین' text
-                alt_anchor = await dl_page.query_selector("a:has-text('آفلاین'), a:has-text('لینک آفلاین')")
-                if alt_anchor:
-                    # follow it - either it will redirect to file or reveal a download link
-                    href2 = await alt_anchor.get_attribute('href')
-                    if href2 and href2.startswith('http'):
-                        logger.info(f"Following secondary offline link to {href2}")
-                        await dl_page.goto(href2, timeout=TIMEOUT_PAGE_LOAD)
-                        # After navigation, attempt to trigger download on the new page
-                        await trigger_download_on_page(dl_page, rar_path, DOWNLOAD_TIMEOUT)
-                    else:
-                        # Last resort: try a click on 'body' or the first 'a' elements
-                        anchors_any = await dl_page.query_selector_all('a')
-                        if anchors_any:
-                            logger.info("Falling back to click on the first anchor in the page")
-                            async with dl_page.expect_download(timeout=DOWNLOAD_TIMEOUT):
-                                await anchors_any[0].click()
+                            await dl_page.goto(href, timeout=TIMEOUT_PAGE_LOAD)
+                        except Exception as e:
+                            logger.warning(f"Goto failed for {href}: {e}; attempting click navigation instead")
+                            # Try to open via navigation by clicking a link from the parent page if available
+                            raise
+                        page_text = await dl_page.inner_text('body')
+                        if "فایل آفلاین این جلسه در حال آماده سازی است" in page_text:
+                            logger.warning(f"The offline file for {filename} is being prepared. Please run the script again in a few hours.")
+                            return False
+                        # Try multiple selector strategies for the actual downloadable file link.
+                        # Prefer direct .rar or .mp4 links; otherwise try download labels in English or Persian.
+                        # Try to directly trigger the download on this page
+                        try:
+                            await trigger_download_on_page(dl_page, rar_path, DOWNLOAD_TIMEOUT)
+                        except Exception as e:
+                            logger.info(f"Direct download on page failed: {e}; trying to follow an offline link or handle popup")
+                            # Try to find 'لینک آفلاین' anchor and follow it
+                            alt_anchor = await dl_page.query_selector("a:has-text('لینک آفلاین'), a[href^=\"https://offline.sbu.ac.ir\"]")
+                            if alt_anchor:
+                                try:
+                                    async with dl_page.expect_popup(timeout=5000) as popup_info:
+                                        await alt_anchor.click()
+                                    popup = await popup_info.value
+                                    try:
+                                        await trigger_download_on_page(popup, rar_path, DOWNLOAD_TIMEOUT)
+                                    finally:
+                                        try:
+                                            await popup.close()
+                                        except Exception:
+                                            pass
+                                except Exception as e2:
+                                    logger.warning(f"Popup download fallback failed: {e2}")
+                                    raise
+                            else:
+                                raise
                         else:
-                            raise Exception('Could not find downloadable link on page')
-                else:
-                    raise Exception('Could not find downloadable link on page')
-            # download saved by trigger_download_on_page or expect_download contexts above
-            try:
-                size = rar_path.stat().st_size
-                logger.info(f"Downloaded (saved) to: {rar_path} ({size} bytes)")
-            except Exception:
-                logger.info(f"Downloaded (saved) to: {rar_path}")
-            break  # Success
-        except Exception as e:
-            logger.warning(f"Download attempt {attempt + 1} failed for {filename}: {e}")
-            if attempt == max_retries - 1:
-                logger.error(f"Failed to download {filename} after {max_retries} attempts.")
-                raise
-        finally:
-            await dl_page.close()
-    
+                            # If no download candidate, try to trigger a navigation to the actual file (some pages have a link inside a button)
+                            # Try to find any anchor with 'آفلاین' text
+                            alt_anchor = await dl_page.query_selector("a:has-text('آفلاین'), a:has-text('لینک آفلاین')")
+                            if alt_anchor:
+                                # follow it - either it will redirect to file or reveal a download link
+                                href2 = await alt_anchor.get_attribute('href')
+                                if href2 and href2.startswith('http'):
+                                    logger.info(f"Following secondary offline link to {href2}")
+                                    await dl_page.goto(href2, timeout=TIMEOUT_PAGE_LOAD)
+                                    # After navigation, attempt to trigger download on the new page
+                                    await trigger_download_on_page(dl_page, rar_path, DOWNLOAD_TIMEOUT)
+                                else:
+                                    # Last resort: try a click on 'body' or the first 'a' elements
+                                    anchors_any = await dl_page.query_selector_all('a')
+                                    if anchors_any:
+                                        logger.info("Falling back to click on the first anchor in the page")
+                                        async with dl_page.expect_download(timeout=DOWNLOAD_TIMEOUT):
+                                            await anchors_any[0].click()
+                                    else:
+                                        raise Exception('Could not find downloadable link on page')
+                            else:
+                                raise Exception('Could not find downloadable link on page')
+                        # download saved by trigger_download_on_page or expect_download contexts above
+                        try:
+                            size = rar_path.stat().st_size
+                            logger.info(f"Downloaded (saved) to: {rar_path} ({size} bytes)")
+                        except Exception:
+                            logger.info(f"Downloaded (saved) to: {rar_path}")
+                        break  # Success
+                    except Exception as e:
+                        logger.warning(f"Download attempt {attempt + 1} failed for {filename}: {e}")
+                        if attempt == max_retries - 1:
+                            logger.error(f"Failed to download {filename} after {max_retries} attempts.")
+                            raise
+            finally:
+                await release_download_page(context, dl_page)
+
+
     # Update downloaded.json with RAR download
     if filename not in downloaded[folder_name]["rars"]:
-        downloaded[folder_name]["rars"].append(filename)
-        save_downloaded(downloaded)
-    
-    # Extract immediately
-    extract_rar(rar_path, extracted_dir)
+        downloaded[folder_name]["rars"].add(filename)
+        save_downloaded(downloaded, folder_name)
     
-    # Add to downloaded if successful
-    if (extracted_dir / mp4_filename).exists():
-        if mp4_filename not in downloaded[folder_name]["mp4s"]:
-            downloaded[folder_name]["mp4s"].append(mp4_filename)
-            save_downloaded(downloaded)
+    # Extract in the background; the manifest is updated when the job finishes
+    task = schedule_extract(rar_path, extracted_dir, downloaded, folder_name, mp4_filename)
+    if extract_tasks is not None:
+        extract_tasks.append(task)
+    return True
+
+
+# Optional fast path for the actual .rar bytes: aria2c pulls with parallel
+# range requests instead of going through Chromium's network stack.
+_ARIA2C = shutil.which("aria2c")
+
+
+async def download_via_aria2c(context: BrowserContext, url: str, rar_path: Path, timeout: int) -> bool:
+    """Download `url` with aria2c, forwarding the context's session cookies.
+
+    Returns False (so callers fall back to the browser download flow) if
+    aria2c is not installed or the transfer fails.
+    """
+    if not _ARIA2C:
+        return False
+    cookies = await context.cookies(url)
+    splits = max(1, SETTINGS.DOWNLOAD_SPLITS)
+    cmd = [
+        _ARIA2C,
+        f"--max-connection-per-server={splits}",
+        f"--split={splits}",
+        "--allow-overwrite=true",
+        # Resume partial files with Range requests instead of restarting from
+        # byte 0 when a retry (or a previous run) left bytes behind
+        "--continue=true",
+        "--auto-file-renaming=false",
+        "--quiet=true",
+        "-d", str(rar_path.parent),
+        "-o", rar_path.name,
+    ]
+    if cookies:
+        cmd += ["--header", "Cookie: " + "; ".join(f"{c['name']}={c['value']}" for c in cookies)]
+    cmd.append(url)
+    rar_path.parent.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Downloading via aria2c: {url} -> {rar_path}")
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout / 1000)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.communicate()
+        logger.warning(f"aria2c timed out downloading {url}")
+        return False
+    if proc.returncode != 0:
+        logger.warning(f"aria2c failed for {url}: {stderr.decode(errors='replace')[:200]}")
+        return False
+    return True
 
 
 async def trigger_download_on_page(page: Page, rar_path: Path, timeout: int) -> None:
@@ -602,6 +1091,14 @@ async def trigger_download_on_page(page: Page, rar_path: Path, timeout: int) ->
             anchors_preview.append({'text': txt.strip(), 'href': href})
         body_preview = (await page.inner_text('body'))[:200]
         raise Exception(f'Could not find downloadable link on offline page. body_snippet={body_preview!r}, anchors={anchors_preview!r}')
+    # If the selected anchor exposes a direct file URL, pull the bytes with
+    # aria2c (parallel range requests) and skip the browser download entirely
+    anchor = await page.query_selector(download_selector)
+    href = (await anchor.get_attribute('href')) if anchor else None
+    if href and href.startswith('http') and ('mp4-' in href or href.endswith(('.rar', '.mp4'))):
+        if await download_via_aria2c(page.context, href, rar_path, timeout):
+            logger.info(f"Downloaded via aria2c to: {rar_path}")
+            return
     # Use expect_download on same page or handle popup
     logger.info(f"Triggering download on page using selector '{download_selector}' for target '{rar_path.name}'")
     async with page.expect_download(timeout=timeout) as download_info:
@@ -618,68 +1115,173 @@ async def trigger_download_on_page(page: Page, rar_path: Path, timeout: int) ->
 
 def sanitize_filename(name: str) -> str:
     """Sanitize string to be a valid filename/directory name."""
-    # Replace invalid characters for Windows filenames
-    invalid_chars = '<>:"|?*\\'
-    for char in invalid_chars:
-        name = name.replace(char, '_')
-    # Remove control characters (ASCII 0-31)
-    name = ''.join(c for c in name if ord(c) >= 32)
+    # Replace invalid Windows filename characters and strip control characters
+    # (ASCII 0-31) in a single C-level pass
+    name = name.translate(_SANITIZE_TABLE)
     # Replace multiple whitespace with single space
-    name = re.sub(r'\s+', ' ', name.strip())
+    name = _WS.sub(' ', name.strip())
     return name
 
 
+# Per-course manifest files live here: downloaded/<folder_name>.json. Updating
+# one course rewrites only its own small file instead of the whole database.
+_MANIFEST_DIR = Path('downloaded')
+
+
+def _entry_to_sets(entry: dict) -> dict:
+    """Store filenames as sets in memory for O(1) membership tests."""
+    entry["rars"] = set(entry.get("rars", []))
+    entry["mp4s"] = set(entry.get("mp4s", []))
+    return entry
+
+
 def load_downloaded() -> dict:
-    """Load downloaded files database."""
-    path = Path('downloaded.json')
-    if path.exists():
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+    """Load downloaded files database from per-course manifest files."""
+    downloaded = dict()
+    # Migrate a legacy monolithic downloaded.json by splitting it per course
+    legacy_path = Path('downloaded.json')
+    if legacy_path.exists():
+        # One-time migration of a possibly large legacy db: read the raw
+        # bytes in one go and hand them to the fast codec directly.
+        with open(legacy_path, 'rb') as f:
+            data = (_orjson.loads if _orjson is not None else json.loads)(f.read())
         # Migrate old format {folder: [mp4s]} to new {folder: {"rars": [], "mp4s": mp4s, ...}}
         if data and isinstance(next(iter(data.values()), None), list):
-            migrated = dict()
             for folder, mp4s in data.items():
-                migrated[folder] = {
-                    "rars": [],  # Assume rars downloaded if mp4s exist
-                    "mp4s": mp4s,
+                downloaded[folder] = {
+                    "rars": set(),  # Assume rars downloaded if mp4s exist
+                    "mp4s": set(mp4s),
                     "download_folder": "",
                     "extract_folder": ""
                 }
-            return migrated
-        return data
-    return {}
+        else:
+            for folder, entry in data.items():
+                downloaded[folder] = _entry_to_sets(entry)
+        for folder, entry in downloaded.items():
+            _write_course_atomic(folder, _serialize_entry(entry))
+        legacy_path.rename(legacy_path.with_name('downloaded.json.bak'))
+        logger.info(f"Migrated downloaded.json into {len(downloaded)} per-course manifests under {_MANIFEST_DIR}/")
+    if _MANIFEST_DIR.is_dir():
+        loads = _orjson.loads if _orjson is not None else json.loads
+        for manifest in _MANIFEST_DIR.glob('*.json'):
+            with open(manifest, 'rb') as f:
+                downloaded[manifest.stem] = _entry_to_sets(loads(f.read()))
+    return downloaded
+
+
+# Write-behind state for the manifests: save_downloaded only marks courses
+# dirty, and a background loop persists just those files shortly afterwards so
+# the event loop never blocks on a rewrite per download/extract.
+_DIRTY_COURSES: set = set()
+_PENDING: Optional[dict] = None
+
+
+def _serialize_entry(entry: dict) -> bytes:
+    """Serialize one course entry to manifest bytes.
+
+    Must run on the event loop: it iterates the live mp4s/rars sets, which
+    download and extraction tasks mutate between awaits.
+    """
+    # default=sorted turns the in-memory filename sets back into sorted lists
+    if _orjson is not None:
+        return _orjson.dumps(entry, default=sorted, option=_orjson.OPT_INDENT_2)
+    return json.dumps(entry, ensure_ascii=False, indent=2, default=sorted).encode('utf-8')
+
+
+def _write_course_atomic(folder_name: str, data: bytes) -> None:
+    """Write one course's manifest via a temp file + os.replace to avoid partial writes."""
+    _MANIFEST_DIR.mkdir(exist_ok=True)
+    path = _MANIFEST_DIR / f"{folder_name}.json"
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def save_downloaded(downloaded: dict, folder_name: Optional[str] = None) -> None:
+    """Mark a course (or all courses) dirty; the flush loop persists them."""
+    global _PENDING
+    _PENDING = downloaded
+    if folder_name is not None:
+        _DIRTY_COURSES.add(folder_name)
+    else:
+        _DIRTY_COURSES.update(downloaded)
+
+
+async def flush_downloaded() -> None:
+    """Persist every dirty course manifest now, off the event loop.
+
+    Serialization happens synchronously on the loop (no task can mutate the
+    sets mid-dump); only the resulting bytes go to a worker thread. A failed
+    write is logged and the course re-marked dirty for the next flush.
+    """
+    if _PENDING is None:
+        return
+    failed = set()
+    while _DIRTY_COURSES:
+        folder_name = _DIRTY_COURSES.pop()
+        entry = _PENDING.get(folder_name)
+        if entry is not None:
+            try:
+                data = _serialize_entry(entry)
+                await asyncio.to_thread(_write_course_atomic, folder_name, data)
+            except Exception as e:
+                logger.warning("Failed to flush manifest for %s: %s", folder_name, e)
+                failed.add(folder_name)
+    _DIRTY_COURSES.update(failed)
+
+
+async def _flush_loop() -> None:
+    """Debounce manifest writes to at most one batch every couple of seconds."""
+    while True:
+        await asyncio.sleep(2)
+        if _DIRTY_COURSES:
+            try:
+                await flush_downloaded()
+            except Exception as e:
+                # Never let a flush error kill the loop; persistence retries
+                logger.warning("Manifest flush failed: %s", e)
 
 
-def save_downloaded(downloaded: dict) -> None:
-    """Save downloaded files database."""
-    path = Path('downloaded.json')
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(downloaded, f, ensure_ascii=False, indent=2)
+_TRUE_STRINGS = frozenset(('yes', 'true', 't', 'y', '1'))
+_FALSE_STRINGS = frozenset(('no', 'false', 'f', 'n', '0'))
 
 
 def str_to_bool(v):
     """Convert string to boolean for argparse."""
     if isinstance(v, bool):
         return v
-    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+    s = v.lower()
+    if s in _TRUE_STRINGS:
         return True
-    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+    elif s in _FALSE_STRINGS:
         return False
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-async def main() -> None:
-    # Load settings from .env and allow override by CLI
-    settings = Settings()
+@functools.lru_cache(maxsize=1)
+def _build_parser() -> argparse.ArgumentParser:
+    """Build the CLI parser once; repeat main() calls reuse the same instance."""
     parser = argparse.ArgumentParser(description="Download and extract SBU LMS videos.")
     parser.add_argument('--username', help='Your LMS username (overrides .env)')
     parser.add_argument('--password', help='Your LMS password (overrides .env)')
     parser.add_argument('--course_id', help='Course ID for recordings (optional, if not provided, process all courses)')
-    parser.add_argument('--output_dir', default=settings.OUTPUT_DIR, help='Output directory for MP4 files')
-    parser.add_argument('--headless', type=str_to_bool, default=settings.HEADLESS, help='Run browser in headless mode (true/false)')
+    parser.add_argument('--output_dir', default=SETTINGS.OUTPUT_DIR, help='Output directory for MP4 files')
+    parser.add_argument('--headless', type=str_to_bool, default=SETTINGS.HEADLESS, help='Run browser in headless mode (true/false)')
+    return parser
 
-    args = parser.parse_args()
+
+async def main() -> None:
+    # Settings are loaded once at import; CLI flags may override below
+    settings = SETTINGS
+    # Bind the concurrency primitives to asyncio.run()'s loop (Python <= 3.9
+    # pins primitives to the loop current at construction time)
+    global DOWNLOAD_SEM, COURSE_SEM, _CONTEXT_LOCK
+    DOWNLOAD_SEM = asyncio.Semaphore(settings.MAX_CONCURRENT_DOWNLOADS)
+    COURSE_SEM = asyncio.Semaphore(settings.MAX_CONCURRENT_COURSES)
+    _CONTEXT_LOCK = asyncio.Lock()
+    args = _build_parser().parse_args()
 
     # Use CLI args if provided, else .env, else prompt
     username = args.username or settings.LMS_USERNAME
@@ -687,64 +1289,85 @@ async def main() -> None:
     username = prompt_if_none(username, 'Enter your LMS username: ')
     password = prompt_if_none(password, 'Enter your LMS password: ', is_password=True)
 
-    # Use .env or CLI for custom directories and timeouts
-    downloads_dir = Path(getattr(settings, 'DOWNLOADS_DIR', 'downloads'))
+    # Use .env or CLI for custom directories; timeouts and the log level are
+    # applied at import time from the shared SETTINGS instance
+    downloads_dir = Path(settings.DOWNLOADS_DIR)
     downloads_dir.mkdir(parents=True, exist_ok=True)
-    output_dir = Path(args.output_dir or getattr(settings, 'OUTPUT_DIR', 'extracted'))
+    output_dir = Path(args.output_dir or settings.OUTPUT_DIR)
     output_dir.mkdir(parents=True, exist_ok=True)
     downloaded = load_downloaded()
-
-    # Set timeouts from settings
-    global TIMEOUT_PAGE_LOAD, DOWNLOAD_TIMEOUT
-    TIMEOUT_PAGE_LOAD = getattr(settings, 'TIMEOUT_PAGE_LOAD', 180000)
-    DOWNLOAD_TIMEOUT = getattr(settings, 'DOWNLOAD_TIMEOUT', 3600000)
-
-    # Set log level from settings
-    import logging
-    log_level = getattr(settings, 'LOG_LEVEL', 'INFO').upper()
-    logger.setLevel(getattr(logging, log_level, logging.INFO))
-
+    flush_task = asyncio.create_task(_flush_loop())
 
     async with async_playwright() as p:
         browser = await p.chromium.launch(headless=args.headless)
         context = await browser.new_context(accept_downloads=True)
+        context.set_default_navigation_timeout(TIMEOUT_PAGE_LOAD)
+
+        # Pre-warm the page pools: one download page per download slot and one
+        # scraping page per concurrently-processed course.
+        _fill_page_pool()
+        for _ in range(settings.MAX_CONCURRENT_DOWNLOADS):
+            PAGE_POOL.put_nowait(await context.new_page())
+        for _ in range(settings.MAX_CONCURRENT_COURSES):
+            COURSE_PAGE_POOL.put_nowait(await context.new_page())
+
         page = await context.new_page()
 
         try:
             await login(page, username, password)
 
             # Use settings concurrency for course metadata fetching
-            course_infos = await get_course_ids(context, page, max_workers=getattr(settings, 'MAX_CONCURRENT_COURSE_FETCH', 6))
+            course_infos = await get_course_ids(context, page, max_workers=settings.MAX_CONCURRENT_COURSE_FETCH)
 
             if args.course_id:
-                # Process single course
-                found = False
-                for cid, cname, onlineclass_id in course_infos:
-                    if cid == args.course_id:
-                        course_dir = output_dir / cname
-                        course_dir.mkdir(parents=True, exist_ok=True)
-                        await process_course(context, cid, downloads_dir, course_dir, downloaded, cname, onlineclass_id)
-                        found = True
-                        break
-                if not found:
+                # Process single course: O(1) lookup instead of a linear scan
+                course_map = {cid: (cname, oid) for cid, cname, oid in course_infos}
+                try:
+                    cname, onlineclass_id = course_map[args.course_id]
+                except KeyError:
                     raise Exception(f"Course {args.course_id} not found")
+                course_dir = output_dir / cname
+                course_dir.mkdir(parents=True, exist_ok=True)
+                await process_course(context, args.course_id, downloads_dir, course_dir, downloaded, cname, onlineclass_id)
             else:
-                # Process all courses
-                for course_id, course_name, onlineclass_id in course_infos:
-                    course_dir = output_dir / course_name
-                    course_dir.mkdir(parents=True, exist_ok=True)
-                    await process_course(context, course_id, downloads_dir, course_dir, downloaded, course_name, onlineclass_id)
+                # Process all courses concurrently in batches; COURSE_SEM inside
+                # process_course bounds how many run at the same time, and the
+                # context is recycled between batches to bound Chromium memory.
+                state = await context.storage_state()
+                # Create every course directory in one pass off the event loop
+                # instead of a stat+mkdir syscall pair per dispatch iteration
+                course_dirs = {cname: output_dir / cname for _, cname, _ in course_infos}
+                await asyncio.to_thread(
+                    lambda: [d.mkdir(parents=True, exist_ok=True) for d in course_dirs.values()]
+                )
+                recycle_every = max(1, settings.CONTEXT_RECYCLE_EVERY)
+                for batch_start in range(0, len(course_infos), recycle_every):
+                    if batch_start:
+                        context = await recycle_context(browser, context, state, settings.MAX_CONCURRENT_DOWNLOADS)
+                    tasks = list()
+                    for course_id, course_name, onlineclass_id in course_infos[batch_start:batch_start + recycle_every]:
+                        tasks.append(process_course(context, course_id, downloads_dir, course_dirs[course_name], downloaded, course_name, onlineclass_id))
+                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                    for r in results:
+                        if isinstance(r, Exception):
+                            logger.warning(f"Course task returned exception: {r}")
 
             save_downloaded(downloaded)
             logger.info("All downloads and extractions completed.")
 
         except Exception as e:
-            logger.error(f"Error: {e}")
+            logger.error("Error: %s", e)
         finally:
+            flush_task.cancel()
+            try:
+                await flush_task
+            except asyncio.CancelledError:
+                pass
+            await flush_downloaded()
             try:
                 await browser.close()
             except Exception as e:
-                logger.warning(f"Error while closing browser: {e}")
+                logger.warning("Error while closing browser: %s", e)
 
 
 if __name__ == '__main__':